@@ -1,45 +1,46 @@
-import copy
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from gym_forestfire.agents.utils import (Critic, amp_enabled, bf16_autocast, build_encoder,
+                                        load_checkpoint, save_checkpoint, target_param_lists,
+                                        td_target)
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# The fused single-kernel Adam step is only used on CUDA
+fused_adam = device.type == "cuda"
+
 
+# Elementwise parts of the train step, kept as plain functions
+def soft_clipped_q(q1: torch.Tensor, q2: torch.Tensor, lmbda: float) -> torch.Tensor:
+    # lmbda * min + (1 - lmbda) * max written with min + max = q1 + q2 and
+    # max - min = |q1 - q2|
+    return 0.5 * (q1 + q2) + (0.5 - lmbda) * torch.abs(q1 - q2)
 
-def init_weights(m):
-    if isinstance(m, (nn.Conv2d, nn.Linear)):
-        nn.init.orthogonal_(m.weight)
 
+def kl_loss(mean: torch.Tensor, log_std: torch.Tensor) -> torch.Tensor:
+    # log(std^2) = 2 * log_std, so the KL term needs no log of std
+    return 0.5 * (mean.pow(2) + (2 * log_std).exp() - 2 * log_std - 1).mean()
 
+
+# The actor and critic take state features: the Encoder output when cnn is
+# set, the flattened state otherwise
 class Actor(nn.Module):
-    def __init__(self, state_dim, action_dim, max_action, image_obs, cnn):
+    # Perturbation model: shifts an action sampled from the VAE by at most
+    # phi * max_action
+    def __init__(self, feature_dim, action_dim, max_action, cnn, phi=0.05):
         super(Actor, self).__init__()
 
-        self.image_obs = image_obs
-        self.cnn = cnn
-        self.cnn_out = state_dim * 4 * 4
-        if image_obs:
-            state_dim = state_dim ** 2
-
-        if image_obs and cnn:
-            self.cnn = nn.Sequential(
-                nn.Conv2d(1, 32, 8, stride=4, padding=0),
-                nn.ReLU(),
-                nn.Conv2d(32, 64, 4, stride=2, padding=0),
-                nn.ReLU(),
-                nn.Conv2d(64, 64, 3, stride=1, padding=0),
-                nn.ReLU(),
-            )
+        if cnn:
             self.fcn = nn.Sequential(
-                nn.Linear(self.cnn_out, 512),
+                nn.Linear(feature_dim + action_dim, 512),
                 nn.ReLU(),
                 nn.Linear(512, 256)
             )
-            self.cnn.apply(init_weights)
         else:
             self.fcn = nn.Sequential(
-                nn.Linear(state_dim, 256),
+                nn.Linear(feature_dim + action_dim, 256),
                 nn.ReLU()
             )
 
@@ -47,93 +48,13 @@ class Actor(nn.Module):
         self.l2 = nn.Linear(256, action_dim)
 
         self.max_action = max_action
-
-    def forward(self, state):
-        if self.image_obs and self.cnn:
-            state = self.cnn(state)
-            state = state.view(-1, self.cnn_out)
-        state = self.fcn(state)
-        a = F.relu(self.l1(state))
-        return self.max_action * torch.tanh(self.l2(a))
-
-
-class Critic(nn.Module):
-    def __init__(self, state_dim, action_dim, image_obs, cnn):
-        super(Critic, self).__init__()
-
-        self.image_obs = image_obs
-        self.cnn = cnn
-        self.cnn_out = state_dim * 4 * 4
-        if image_obs:
-            state_dim = state_dim ** 2
-
-        if image_obs and cnn:
-            self.cnn = nn.Sequential(
-                nn.Conv2d(1, 32, 8, stride=4, padding=0),
-                nn.ReLU(),
-                nn.Conv2d(32, 64, 4, stride=2, padding=0),
-                nn.ReLU(),
-                nn.Conv2d(64, 64, 3, stride=1, padding=0),
-                nn.ReLU()
-            )
-            self.fcn_1 = nn.Sequential(
-                nn.Linear(self.cnn_out + action_dim, 512),
-                nn.ReLU(),
-                nn.Linear(512, 256)
-            )
-            self.fcn_2 = nn.Sequential(
-                nn.Linear(self.cnn_out + action_dim, 512),
-                nn.ReLU(),
-                nn.Linear(512, 256)
-            )
-            self.cnn.apply(init_weights)
-        else:
-            self.fcn_1 = nn.Sequential(
-                nn.Linear(state_dim + action_dim, 256),
-                nn.ReLU()
-            )
-            self.fcn_2 = nn.Sequential(
-                nn.Linear(state_dim + action_dim, 256),
-                nn.ReLU()
-            )
-
-        # Q1 architecture
-        self.l1 = nn.Linear(256, 256)
-        self.l2 = nn.Linear(256, 1)
-
-        # Q2 architecture
-        self.l3 = nn.Linear(256, 256)
-        self.l4 = nn.Linear(256, 1)
+        self.phi = phi
 
     def forward(self, state, action):
-        if self.image_obs and self.cnn:
-            state = self.cnn(state)
-            state = state.view(-1, self.cnn_out)
-            sa = torch.cat([state, action], 1)
-        else:
-            sa = torch.cat([state, action], 1)
-
-        q1 = self.fcn_1(sa)
-        q1 = F.relu(self.l1(q1))
-        q1 = self.l2(q1)
-
-        q2 = self.fcn_2(sa)
-        q2 = F.relu(self.l3(q2))
-        q2 = self.l4(q2)
-        return q1, q2
-
-    def Q1(self, state, action):
-        if self.image_obs and self.cnn:
-            state = self.cnn(state)
-            state = state.view(-1, self.cnn_out)
-            sa = torch.cat([state, action], 1)
-        else:
-            sa = torch.cat([state, action], 1)
-
-        q1 = self.fcn_1(sa)
-        q1 = F.relu(self.l1(q1))
-        q1 = self.l2(q1)
-        return q1
+        a = self.fcn(torch.cat([state, action], -1))
+        a = F.relu(self.l1(a))
+        a = self.phi * self.max_action * torch.tanh(self.l2(a))
+        return (a + action).clamp(-self.max_action, self.max_action)
 
 
 # Vanilla Variational Auto-Encoder
@@ -166,15 +87,15 @@ class VAE(nn.Module):
 
         u = self.decode(state, z)
 
-        return u, mean, std
+        return u, mean, log_std
 
     def decode(self, state, z=None):
         # When sampling from the VAE, the latent vector is clipped to [-0.5, 0.5]
         if z is None:
-            z = torch.randn((state.shape[0], self.latent_dim)).to(
-                self.device).clamp(-0.5, 0.5)
+            z = torch.randn(state.shape[:-1] + (self.latent_dim,),
+                            device=state.device).clamp_(-0.5, 0.5)
 
-        a = F.relu(self.d1(torch.cat([state, z], 1)))
+        a = F.relu(self.d1(torch.cat([state, z], -1)))
         a = F.relu(self.d2(a))
         return self.max_action * torch.tanh(self.d3(a))
 
@@ -186,22 +107,34 @@ class BCQ(object):
                  policy_noise=0.2,
                  noise_clip=0.5,
                  policy_freq=2,
-                 cnn=False, image_obs=False):
+                 cnn=False, image_obs=False, amp=True):
         latent_dim = action_dim * 2
 
-        self.actor = Actor(state_dim, action_dim, max_action,image_obs,cnn).to(device)
-        self.actor_target = copy.deepcopy(self.actor)
+        self.encoder, self.encoder_target, feature_dim = build_encoder(
+            state_dim, image_obs, cnn, device)
+        self.use_cnn = use_cnn = image_obs and cnn
+
+        self.actor = Actor(feature_dim, action_dim, max_action, use_cnn, phi).to(device)
+        self.actor_target = Actor(feature_dim, action_dim, max_action, use_cnn, phi).to(device)
+        self.actor_target.load_state_dict(self.actor.state_dict())
+        self.actor_target.requires_grad_(False)
         self.actor_optimizer = torch.optim.Adam(
-            self.actor.parameters(), lr=1e-3)
+            self.actor.parameters(), lr=1e-3, fused=fused_adam)
 
-        self.critic = Critic(state_dim, action_dim,image_obs,cnn).to(device)
-        self.critic_target = copy.deepcopy(self.critic)
+        self.critic = Critic(feature_dim, action_dim, use_cnn).to(device)
+        self.critic_target = Critic(feature_dim, action_dim, use_cnn).to(device)
+        self.critic_target.load_state_dict(self.critic.state_dict())
+        self.critic_target.requires_grad_(False)
+        # The encoder is trained by the critic loss only
         self.critic_optimizer = torch.optim.Adam(
-            self.critic.parameters(), lr=1e-3)
+            list(self.critic.parameters()) + list(self.encoder.parameters()),
+            lr=1e-3, fused=fused_adam)
 
-        self.vae = VAE(state_dim, action_dim, latent_dim,
+        # The VAE works on the flattened state, not on the encoder features
+        self.vae = VAE(state_dim ** 2 if image_obs else state_dim, action_dim, latent_dim,
                        max_action, device).to(device)
-        self.vae_optimizer = torch.optim.Adam(self.vae.parameters())
+        self.vae_optimizer = torch.optim.Adam(
+            self.vae.parameters(), fused=fused_adam)
 
         self.max_action = max_action
         self.image_obs = image_obs
@@ -215,13 +148,51 @@ class BCQ(object):
         self.noise_clip = noise_clip
         self.policy_freq = policy_freq
         self.total_it = 0
+        self.amp = amp_enabled(amp, device)
+
+        # The encoder follows the critic's target update
+        self.critic_params, self.critic_target_params = target_param_lists(
+            (self.critic, self.critic_target), (self.encoder, self.encoder_target))
+        self.actor_params, self.actor_target_params = target_param_lists(
+            (self.actor, self.actor_target))
+
+        # Reused latent noise for VAE sampling in train, sized for the default
+        # batch of 100 with 10 samples per next state
+        self._noise_buf = torch.empty((1000, latent_dim), device=device)
+
+        # Persistent select_action input, staged through pinned memory on GPU
+        input_shape = (1, state_dim ** 2 if image_obs else state_dim)
+        self._inf_state = torch.empty(input_shape, device=device)
+        self._inf_state_host = torch.empty(input_shape, pin_memory=device.type == "cuda")
+
+    def _sample_latent(self, n):
+        # Clipped latent noise written into the shared buffer, grown on demand
+        if self._noise_buf.shape[0] < n:
+            self._noise_buf = torch.empty(
+                (n, self._noise_buf.shape[1]), device=self.device)
+        return self._noise_buf[:n].normal_().clamp_(-0.5, 0.5)
+
+    def autocast(self):
+        return bf16_autocast(device, self.amp)
 
     def select_action(self, state):
-        with torch.no_grad():
-            state = torch.FloatTensor(state.reshape(
-                1, -1)).repeat(100, 1).to(self.device)
-            action = self.actor(state, self.vae.decode(state))
-            q1 = self.critic.q1(state, action)
+        with torch.inference_mode():
+            state = torch.as_tensor(state).reshape(self._inf_state.shape)
+            if self.device.type == "cuda":
+                self._inf_state_host.copy_(state)
+                self._inf_state.copy_(self._inf_state_host, non_blocking=True)
+            else:
+                self._inf_state.copy_(state)
+
+            # Only the latent sample differs between the 100 candidates, so
+            # the state and its encoding are broadcast as views. The critic
+            # takes the single (1, F) encoding and projects it only once
+            state_emb = self.encoder(self._inf_state)
+            state = self._inf_state.expand(100, -1)
+            z = torch.randn((100, self.vae.latent_dim),
+                            device=self.device).clamp(-0.5, 0.5)
+            action = self.actor(state_emb.expand(100, -1), self.vae.decode(state, z))
+            q1 = self.critic.Q1(state_emb, action)
             ind = q1.argmax(0)
         return action[ind].cpu().data.numpy().flatten()
 
@@ -233,77 +204,73 @@ class BCQ(object):
                 batch_size)
 
             # Variational Auto-Encoder Training
-            recon, mean, std = self.vae(state, action)
-            recon_loss = F.mse_loss(recon, action)
-            KL_loss = -0.5 * (1 + torch.log(std.pow(2)) -
-                              mean.pow(2) - std.pow(2)).mean()
-            vae_loss = recon_loss + 0.5 * KL_loss
+            with self.autocast():
+                recon, mean, log_std = self.vae(state, action)
+                recon_loss = F.mse_loss(recon, action)
+                KL_loss = kl_loss(mean, log_std)
+                vae_loss = recon_loss + 0.5 * KL_loss
 
-            self.vae_optimizer.zero_grad()
+            self.vae_optimizer.zero_grad(set_to_none=True)
             vae_loss.backward()
             self.vae_optimizer.step()
 
             # Critic Training
-            with torch.no_grad():
-                # Duplicate next state 10 times
-                next_state = torch.repeat_interleave(next_state, 10, 0)
+            with torch.no_grad(), self.autocast():
+                # Duplicate next state 10 times as a (batch, 10, ...) view. It is
+                # encoded once per state for both target networks and broadcast
+                next_state_emb = self.encoder_target(next_state).unsqueeze(1)
+                next_state = next_state.unsqueeze(1).expand(-1, 10, -1)
+                z = self._sample_latent(batch_size * 10).view(batch_size, 10, -1)
 
                 # Compute value of perturbed actions sampled from the VAE
                 target_Q1, target_Q2 = self.critic_target(
-                    next_state, self.actor_target(next_state, self.vae.decode(next_state)))
+                    next_state_emb, self.actor_target(next_state_emb.expand(-1, 10, -1),
+                                                      self.vae.decode(next_state, z)))
 
                 # Soft Clipped Double Q-learning
-                target_Q = self.lmbda * \
-                    torch.min(target_Q1, target_Q2) + (1. -
-                                                       self.lmbda) * torch.max(target_Q1, target_Q2)
+                target_Q = soft_clipped_q(target_Q1, target_Q2, self.lmbda)
                 # Take max over each action sampled from the VAE
                 target_Q = target_Q.reshape(
                     batch_size, -1).max(1)[0].reshape(-1, 1)
 
-                target_Q = reward + not_done * self.discount * target_Q
+                target_Q = td_target(reward, not_done, self.discount, target_Q)
 
-            current_Q1, current_Q2 = self.critic(state, action)
-            critic_loss = F.mse_loss(
-                current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q)
+            with self.autocast():
+                current_Q1, current_Q2 = self.critic(self.encoder(state), action)
+                critic_loss = F.mse_loss(
+                    current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q)
 
-            self.critic_optimizer.zero_grad()
+            self.critic_optimizer.zero_grad(set_to_none=True)
             critic_loss.backward()
             self.critic_optimizer.step()
 
-            # Pertubation Model / Action Training
-            sampled_actions = self.vae.decode(state)
-            perturbed_actions = self.actor(state, sampled_actions)
+            with self.autocast():
+                # The critic step just changed the encoder, so the states are
+                # encoded again, once for both the actor and the critic. No
+                # autograd here: the encoder only learns from the critic loss
+                with torch.no_grad():
+                    state_emb = self.encoder(state)
+
+                # Pertubation Model / Action Training
+                sampled_actions = self.vae.decode(
+                    state, self._sample_latent(state.shape[0]))
+                perturbed_actions = self.actor(state_emb, sampled_actions)
 
-            # Update through DPG
-            actor_loss = -self.critic.q1(state, perturbed_actions).mean()
+                # Update through DPG
+                actor_loss = -self.critic.Q1(state_emb, perturbed_actions).mean()
 
-            self.actor_optimizer.zero_grad()
+            self.actor_optimizer.zero_grad(set_to_none=True)
             actor_loss.backward()
             self.actor_optimizer.step()
 
             # Update Target Networks
-            for param, target_param in zip(self.critic.parameters(), self.critic_target.parameters()):
-                target_param.data.copy_(
-                    self.tau * param.data + (1 - self.tau) * target_param.data)
-
-            for param, target_param in zip(self.actor.parameters(), self.actor_target.parameters()):
-                target_param.data.copy_(
-                    self.tau * param.data + (1 - self.tau) * target_param.data)
-    
-    def save(self, filename):
-        
-        torch.save(self.critic.state_dict(), filename + "_critic")
-        torch.save(self.critic_optimizer.state_dict(), filename + "_critic_optimizer")
+            torch._foreach_lerp_(self.critic_target_params, self.critic_params, self.tau)
 
-        torch.save(self.actor.state_dict(), filename + "_actor")
-        torch.save(self.actor_optimizer.state_dict(), filename + "_actor_optimizer")
+            torch._foreach_lerp_(self.actor_target_params, self.actor_params, self.tau)
 
-    def load(self, filename):
-        self.critic.load_state_dict(torch.load(filename + "_critic"))
-        self.critic_optimizer.load_state_dict(torch.load(filename + "_critic_optimizer"))
-        self.critic_target = copy.deepcopy(self.critic)
+    def save(self, filename):
+        save_checkpoint(self, filename)
 
-        self.actor.load_state_dict(torch.load(filename + "_actor"))
-        self.actor_optimizer.load_state_dict(torch.load(filename + "_actor_optimizer"))
-        self.actor_target = copy.deepcopy(self.actor)
+    def load(self, filename):
+        load_checkpoint(self, filename)
         print("\nloaded the model successfully\n")
@@ -1,46 +1,38 @@
-import copy
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from gym_forestfire.agents.utils import (Critic, amp_enabled, bf16_autocast, build_encoder,
+                                        load_checkpoint, save_checkpoint, target_param_lists,
+                                        td_target)
+
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# The fused single-kernel Adam step is only used on CUDA
+fused_adam = device.type == "cuda"
 
 
-def init_weights(m):
-    if isinstance(m, (nn.Conv2d, nn.Linear)):
-        nn.init.orthogonal_(m.weight)
+# Target policy smoothing noise
+def clipped_noise(action: torch.Tensor, policy_noise: float, noise_clip: float) -> torch.Tensor:
+    return (torch.randn_like(action) * policy_noise).clamp(-noise_clip, noise_clip)
 
 
+# The actor and critic take state features: the Encoder output when cnn is
+# set, the flattened state otherwise
 class Actor(nn.Module):
-    def __init__(self, state_dim, action_dim, max_action, image_obs, cnn):
+    def __init__(self, feature_dim, action_dim, max_action, cnn):
         super(Actor, self).__init__()
 
-        self.image_obs = image_obs
-        self.cnn = cnn
-        self.cnn_out = state_dim * 4 * 4
-        if image_obs:
-            state_dim = state_dim ** 2
-
-        if image_obs and cnn:
-            self.cnn = nn.Sequential(
-                nn.Conv2d(1, 32, 8, stride=4, padding=0),
-                nn.ReLU(),
-                nn.Conv2d(32, 64, 4, stride=2, padding=0),
-                nn.ReLU(),
-                nn.Conv2d(64, 64, 3, stride=1, padding=0),
-                nn.ReLU(),
-            )
+        if cnn:
             self.fcn = nn.Sequential(
-                nn.Linear(self.cnn_out, 512),
+                nn.Linear(feature_dim, 512),
                 nn.ReLU(),
                 nn.Linear(512, 256)
             )
-            self.cnn.apply(init_weights)
         else:
             self.fcn = nn.Sequential(
-                nn.Linear(state_dim, 256),
+                nn.Linear(feature_dim, 256),
                 nn.ReLU()
             )
 
@@ -50,93 +42,11 @@ class Actor(nn.Module):
         self.max_action = max_action
 
     def forward(self, state):
-        if self.image_obs and self.cnn:
-            state = self.cnn(state)
-            state = state.view(-1, self.cnn_out)
         state = self.fcn(state)
         a = F.relu(self.l1(state))
         return self.max_action * torch.tanh(self.l2(a))
 
 
-class Critic(nn.Module):
-    def __init__(self, state_dim, action_dim, image_obs, cnn):
-        super(Critic, self).__init__()
-
-        self.image_obs = image_obs
-        self.cnn = cnn
-        self.cnn_out = state_dim * 4 * 4
-        if image_obs:
-            state_dim = state_dim ** 2
-
-        if image_obs and cnn:
-            self.cnn = nn.Sequential(
-                nn.Conv2d(1, 32, 8, stride=4, padding=0),
-                nn.ReLU(),
-                nn.Conv2d(32, 64, 4, stride=2, padding=0),
-                nn.ReLU(),
-                nn.Conv2d(64, 64, 3, stride=1, padding=0),
-                nn.ReLU()
-            )
-            self.fcn_1 = nn.Sequential(
-                nn.Linear(self.cnn_out + action_dim, 512),
-                nn.ReLU(),
-                nn.Linear(512, 256)
-            )
-            self.fcn_2 = nn.Sequential(
-                nn.Linear(self.cnn_out + action_dim, 512),
-                nn.ReLU(),
-                nn.Linear(512, 256)
-            )
-            self.cnn.apply(init_weights)
-        else:
-            self.fcn_1 = nn.Sequential(
-                nn.Linear(state_dim + action_dim, 256),
-                nn.ReLU()
-            )
-            self.fcn_2 = nn.Sequential(
-                nn.Linear(state_dim + action_dim, 256),
-                nn.ReLU()
-            )
-
-        # Q1 architecture
-        self.l1 = nn.Linear(256, 256)
-        self.l2 = nn.Linear(256, 1)
-
-        # Q2 architecture
-        self.l3 = nn.Linear(256, 256)
-        self.l4 = nn.Linear(256, 1)
-
-    def forward(self, state, action):
-        if self.image_obs and self.cnn:
-            state = self.cnn(state)
-            state = state.view(-1, self.cnn_out)
-            sa = torch.cat([state, action], 1)
-        else:
-            sa = torch.cat([state, action], 1)
-
-        q1 = self.fcn_1(sa)
-        q1 = F.relu(self.l1(q1))
-        q1 = self.l2(q1)
-
-        q2 = self.fcn_2(sa)
-        q2 = F.relu(self.l3(q2))
-        q2 = self.l4(q2)
-        return q1, q2
-
-    def Q1(self, state, action):
-        if self.image_obs and self.cnn:
-            state = self.cnn(state)
-            state = state.view(-1, self.cnn_out)
-            sa = torch.cat([state, action], 1)
-        else:
-            sa = torch.cat([state, action], 1)
-
-        q1 = self.fcn_1(sa)
-        q1 = F.relu(self.l1(q1))
-        q1 = self.l2(q1)
-        return q1
-
-
 class TD3(object):
     def __init__(
             self,
@@ -150,15 +60,26 @@ class TD3(object):
             noise_clip=0.5,
             policy_freq=2,
             cnn=False,
+            amp=True,
     ):
-
-        self.actor = Actor(state_dim, action_dim, max_action, image_obs, cnn).to(device)
-        self.actor_target = copy.deepcopy(self.actor)
-        self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=3e-4)
-
-        self.critic = Critic(state_dim, action_dim, image_obs, cnn).to(device)
-        self.critic_target = copy.deepcopy(self.critic)
-        self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=3e-4)
+        self.encoder, self.encoder_target, feature_dim = build_encoder(
+            state_dim, image_obs, cnn, device)
+        self.use_cnn = use_cnn = image_obs and cnn
+
+        self.actor = Actor(feature_dim, action_dim, max_action, use_cnn).to(device)
+        self.actor_target = Actor(feature_dim, action_dim, max_action, use_cnn).to(device)
+        self.actor_target.load_state_dict(self.actor.state_dict())
+        self.actor_target.requires_grad_(False)
+        self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=3e-4, fused=fused_adam)
+
+        self.critic = Critic(feature_dim, action_dim, use_cnn).to(device)
+        self.critic_target = Critic(feature_dim, action_dim, use_cnn).to(device)
+        self.critic_target.load_state_dict(self.critic.state_dict())
+        self.critic_target.requires_grad_(False)
+        # The encoder is trained by the critic loss only
+        self.critic_optimizer = torch.optim.Adam(
+            list(self.critic.parameters()) + list(self.encoder.parameters()),
+            lr=3e-4, fused=fused_adam)
 
         self.max_action = max_action
         self.image_obs = image_obs
@@ -169,27 +90,46 @@ class TD3(object):
         self.noise_clip = noise_clip
         self.policy_freq = policy_freq
         self.total_it = 0
+        self.amp = amp_enabled(amp, device)
 
-    def select_action(self, state):
-        if self.image_obs and self.cnn:
-            state = torch.FloatTensor(state.reshape(1, 1, 64, 64)).to(device)
+        # The encoder follows the critic's target update
+        self.critic_params, self.critic_target_params = target_param_lists(
+            (self.critic, self.critic_target), (self.encoder, self.encoder_target))
+        self.actor_params, self.actor_target_params = target_param_lists(
+            (self.actor, self.actor_target))
+
+        # Persistent select_action input, staged through pinned memory on GPU
+        if image_obs and cnn:
+            input_shape = (1, 1, state_dim, state_dim)
         else:
-            state = torch.FloatTensor(state.reshape(1, -1)).to(device)
-        return self.actor(state).cpu().data.numpy().flatten()
+            input_shape = (1, state_dim ** 2 if image_obs else state_dim)
+        self._inf_state = torch.empty(input_shape, device=device)
+        self._inf_state_host = torch.empty(input_shape, pin_memory=device.type == "cuda")
+
+    def autocast(self):
+        return bf16_autocast(device, self.amp)
+
+    def select_action(self, state):
+        with torch.inference_mode():
+            state = torch.as_tensor(state).reshape(self._inf_state.shape)
+            if device.type == "cuda":
+                self._inf_state_host.copy_(state)
+                self._inf_state.copy_(self._inf_state_host, non_blocking=True)
+            else:
+                self._inf_state.copy_(state)
+            return self.actor(self.encoder(self._inf_state)).cpu().numpy().flatten()
 
     def train(self, replay_buffer, batch_size=100):
         self.total_it += 1
         # Sample replay buffer
         state, action, next_state, reward, not_done = replay_buffer.sample(batch_size)
-        if self.image_obs and self.cnn:
-            state = state.view(-1, 1, 64, 64)
-            next_state = next_state.view(-1, 1, 64, 64)
 
-        with torch.no_grad():
+        with torch.no_grad(), self.autocast():
+            # Next states are encoded once for both target networks
+            next_state = self.encoder_target(next_state)
+
             # Select action according to policy and add clipped noise
-            noise = (
-                    torch.randn_like(action) * self.policy_noise
-            ).clamp(-self.noise_clip, self.noise_clip)
+            noise = clipped_noise(action, self.policy_noise, self.noise_clip)
 
             next_action = (
                     self.actor_target(next_state) + noise
@@ -198,52 +138,47 @@ class TD3(object):
             # Compute the target Q value
             target_Q1, target_Q2 = self.critic_target(next_state, next_action)
             target_Q = torch.min(target_Q1, target_Q2)
-            target_Q = reward + not_done * self.discount * target_Q
+            target_Q = td_target(reward, not_done, self.discount, target_Q)
 
-        # Get current Q estimates
-        current_Q1, current_Q2 = self.critic(state, action)
+        with self.autocast():
+            # Get current Q estimates
+            current_Q1, current_Q2 = self.critic(self.encoder(state), action)
 
-        # Compute critic loss
-        critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q)
+            # Compute critic loss
+            critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q)
 
         # Optimize the critic
-        self.critic_optimizer.zero_grad()
+        self.critic_optimizer.zero_grad(set_to_none=True)
         critic_loss.backward()
         self.critic_optimizer.step()
 
         # Delayed policy updates
         if self.total_it % self.policy_freq == 0:
 
-            # Compute actor losse
-            actor_loss = -self.critic.Q1(state, self.actor(state)).mean()
+            with self.autocast():
+                # The critic step just changed the encoder, so the states are
+                # encoded again, once for both the actor and the critic. No
+                # autograd here: the encoder only learns from the critic loss
+                with torch.no_grad():
+                    state = self.encoder(state)
+
+                # Compute actor losse
+                actor_loss = -self.critic.Q1(state, self.actor(state)).mean()
 
             # Optimize the actor
-            self.actor_optimizer.zero_grad()
+            self.actor_optimizer.zero_grad(set_to_none=True)
             actor_loss.backward()
             self.actor_optimizer.step()
 
             # Update the frozen target models
-            for param, target_param in zip(self.critic.parameters(), self.critic_target.parameters()):
-                target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
+            torch._foreach_lerp_(self.critic_target_params, self.critic_params, self.tau)
 
-            for param, target_param in zip(self.actor.parameters(), self.actor_target.parameters()):
-                target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
+            torch._foreach_lerp_(self.actor_target_params, self.actor_params, self.tau)
 
     def save(self, filename):
         print("This ran" + filename )
-        torch.save(self.critic.state_dict(), filename + "_critic")
-        torch.save(self.critic_optimizer.state_dict(), filename + "_critic_optimizer")
-
-        torch.save(self.actor.state_dict(), filename + "_actor")
-        torch.save(self.actor_optimizer.state_dict(), filename + "_actor_optimizer")
+        save_checkpoint(self, filename)
 
     def load(self, filename):
-
-        self.critic.load_state_dict(torch.load(filename + "_critic"))
-        self.critic_optimizer.load_state_dict(torch.load(filename + "_critic_optimizer"))
-        self.critic_target = copy.deepcopy(self.critic)
-
-        self.actor.load_state_dict(torch.load(filename + "_actor"))
-        self.actor_optimizer.load_state_dict(torch.load(filename + "_actor_optimizer"))
-        self.actor_target = copy.deepcopy(self.actor)
-        print("\nfiles loaded successfully\n" + filename)
\ No newline at end of file
+        load_checkpoint(self, filename)
+        print("\nfiles loaded successfully\n" + filename)
@@ -1,5 +1,10 @@
+import queue
+import threading
+
 import numpy as np
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 
 
 class ReplayBuffer(object):
@@ -17,24 +22,348 @@ class ReplayBuffer(object):
         self.not_done = np.zeros((max_size, 1),dtype='uint8')
 
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # Guards the storage when batches are sampled from another thread
+        self.lock = threading.Lock()
 
     def add(self, state, action, next_state, reward, done):
-        self.state[self.ptr] = state.reshape(1, -1)
-        self.action[self.ptr] = action
-        self.next_state[self.ptr] = next_state.reshape(1, -1)
-        self.reward[self.ptr] = reward
-        self.not_done[self.ptr] = 1. - done
+        with self.lock:
+            self.state[self.ptr] = state.reshape(1, -1)
+            self.action[self.ptr] = action
+            self.next_state[self.ptr] = next_state.reshape(1, -1)
+            self.reward[self.ptr] = reward
+            self.not_done[self.ptr] = 1. - done
+
+            self.ptr = (self.ptr + 1) % self.max_size
+            self.size = min(self.size + 1, self.max_size)
 
-        self.ptr = (self.ptr + 1) % self.max_size
-        self.size = min(self.size + 1, self.max_size)
+    def sample_arrays(self, batch_size, rng=None):
+        # rng is a numpy Generator, without one the global numpy RNG is used
+        with self.lock:
+            if rng is None:
+                ind = np.random.randint(0, self.size, size=batch_size)
+            else:
+                ind = rng.integers(0, self.size, size=batch_size)
+
+            return (
+                self.state[ind],
+                self.action[ind],
+                self.next_state[ind],
+                self.reward[ind],
+                self.not_done[ind]
+            )
 
     def sample(self, batch_size):
-        ind = np.random.randint(0, self.size, size=batch_size)
-
-        return (
-            torch.FloatTensor(self.state[ind]).to(self.device),
-            torch.FloatTensor(self.action[ind]).to(self.device),
-            torch.FloatTensor(self.next_state[ind]).to(self.device),
-            torch.FloatTensor(self.reward[ind]).to(self.device),
-            torch.FloatTensor(self.not_done[ind]).to(self.device)
+        return tuple(
+            torch.FloatTensor(a).to(self.device) for a in self.sample_arrays(batch_size)
         )
+
+
+class PrefetchReplayBuffer(object):
+    # Wraps a ReplayBuffer and samples upcoming batches in a background thread.
+    # On the GPU the batches are staged in pinned memory and copied on a side
+    # stream, so the host-to-device copy overlaps with the current train step.
+    # The thread starts on the first sample, once training begins.
+    def __init__(self, replay_buffer, batch_size, depth=2):
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.device = replay_buffer.device
+        self.queue = queue.Queue(maxsize=depth)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.thread = None
+        # Set by the thread when sampling fails, raised on every later sample
+        self.error = None
+        # The thread draws its indices from its own RNG, so seeded runs do not
+        # depend on how its draws interleave with the main thread's
+        self.rng = np.random.default_rng(np.random.randint(2 ** 32))
+        self.stop = threading.Event()
+
+    def add(self, state, action, next_state, reward, done):
+        self.replay_buffer.add(state, action, next_state, reward, done)
+
+    def sample(self, batch_size):
+        if batch_size != self.batch_size:
+            return self.replay_buffer.sample(batch_size)
+
+        if self.stop.is_set():
+            raise RuntimeError("sample() on a closed PrefetchReplayBuffer")
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._prefetch, daemon=True)
+            self.thread.start()
+
+        if self.error is not None:
+            raise self.error
+        batch, event = self.queue.get()
+        if batch is None:
+            raise self.error
+        if event is not None:
+            # Wait for the copy and keep the side stream's memory alive for
+            # as long as the main stream uses it
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            for t in batch:
+                t.record_stream(stream)
+        return batch
+
+    def close(self):
+        # Stops the thread and drops the queued batches, so that the wrapped
+        # buffer and the pinned memory can be freed
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def _put(self, item):
+        # Waits for a free slot in short steps so that close() is noticed
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _prefetch(self):
+        try:
+            while not self.stop.is_set():
+                arrays = self.replay_buffer.sample_arrays(self.batch_size, self.rng)
+                if self.stream is None:
+                    self._put((tuple(torch.from_numpy(a).float() for a in arrays), None))
+                    continue
+
+                # Copied as uint8 and converted on the device, a quarter of the bytes
+                host = [torch.from_numpy(a).pin_memory() for a in arrays]
+                with torch.cuda.stream(self.stream):
+                    batch = tuple(t.to(self.device, non_blocking=True).float() for t in host)
+                    event = torch.cuda.Event()
+                    event.record(self.stream)
+                self._put((batch, event))
+        except Exception as e:
+            self.error = e
+            self._put((None, None))
+
+
+# Network pieces and train step helpers shared by the BCQ and TD3 agents
+
+
+def init_weights(m):
+    if isinstance(m, (nn.Conv2d, nn.Linear)):
+        nn.init.orthogonal_(m.weight)
+
+
+# Bootstrapped target of the critic update
+def td_target(reward: torch.Tensor, not_done: torch.Tensor, discount: float,
+              target_Q: torch.Tensor) -> torch.Tensor:
+    return reward + not_done * discount * target_Q
+
+
+# n independent linear layers evaluated as one batched matmul. Input is
+# (k, batch, in_features) with k <= n, so the first head can run on its own.
+class StackedLinear(nn.Module):
+    def __init__(self, n, in_features, out_features):
+        super(StackedLinear, self).__init__()
+        self.weight = nn.Parameter(torch.empty(n, in_features, out_features))
+        self.bias = nn.Parameter(torch.empty(n, 1, out_features))
+        # Same distribution as the default nn.Linear initialisation
+        bound = 1. / np.sqrt(in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        k = x.shape[0]
+        return torch.baddbmm(self.bias[:k], x, self.weight[:k])
+
+
+# Conv stack for image observations, shared by the actor and critic heads
+class Encoder(nn.Module):
+    def __init__(self, state_dim):
+        super(Encoder, self).__init__()
+
+        self.state_dim = state_dim
+        self.cnn = nn.Sequential(
+            nn.Conv2d(1, 32, 8, stride=4, padding=0),
+            nn.ReLU(),
+            nn.Conv2d(32, 64, 4, stride=2, padding=0),
+            nn.ReLU(),
+            nn.Conv2d(64, 64, 3, stride=1, padding=0),
+            nn.ReLU()
+        )
+        self.cnn.apply(init_weights)
+
+        # Flattened feature size for this input size, found with one dry run
+        with torch.no_grad():
+            self.out_dim = self.cnn(torch.zeros(1, 1, state_dim, state_dim)).numel()
+
+    def forward(self, state):
+        state = state.view(-1, 1, self.state_dim, self.state_dim)
+        return self.cnn(state).view(-1, self.out_dim)
+
+
+class Critic(nn.Module):
+    def __init__(self, feature_dim, action_dim, cnn):
+        super(Critic, self).__init__()
+
+        # Q1 and Q2 first layers are stacked into one projection, split
+        # into state and action parts instead of concatenating the inputs
+        if cnn:
+            self.fcn_state = nn.Linear(feature_dim, 2 * 512, bias=False)
+            self.fcn_action = nn.Linear(action_dim, 2 * 512)
+            self.fcn_out = StackedLinear(2, 512, 256)
+        else:
+            self.fcn_state = nn.Linear(feature_dim, 2 * 256, bias=False)
+            self.fcn_action = nn.Linear(action_dim, 2 * 256)
+            self.fcn_out = nn.Identity()
+
+        # Same initialisation as the unsplit nn.Linear(state + action)
+        bound = 1. / np.sqrt(feature_dim + action_dim)
+        for w in (self.fcn_state.weight, self.fcn_action.weight, self.fcn_action.bias):
+            nn.init.uniform_(w, -bound, bound)
+
+        # Q1 and Q2 architectures, stacked along the first dimension
+        self.l1 = StackedLinear(2, 256, 256)
+        self.l2 = StackedLinear(2, 256, 1)
+
+    def forward(self, state, action):
+        q = self._heads(state, action, 2)
+        return q[0], q[1]
+
+    def Q1(self, state, action):
+        return self._heads(state, action, 1)[0]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Old checkpoints keep one unstacked layer per Q head
+        if prefix + "fcn_1.0.weight" in state_dict:
+            remap_legacy_critic(state_dict, prefix, self.fcn_action.in_features)
+        super(Critic, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _heads(self, state, action, n):
+        # Runs the first n Q heads; n=1 only touches the Q1 slice of the weights
+        # state only has to broadcast against action, so a state shared by
+        # several actions is projected once
+        width = self.fcn_action.out_features // 2
+        q = F.linear(state, self.fcn_state.weight[:n * width]) + F.linear(
+            action, self.fcn_action.weight[:n * width], self.fcn_action.bias[:n * width])
+        q = F.relu(q)
+        q = q.view(-1, n, width).transpose(0, 1)
+        q = self.fcn_out(q)
+        q = F.relu(self.l1(q))
+        # bf16 values near 300 are 2.0 apart, too coarse for Q values, so the
+        # output layer and the targets and losses built on it stay in fp32
+        with torch.autocast(device_type=q.device.type, enabled=False):
+            return self.l2(q.float())
+
+
+def build_encoder(state_dim, image_obs, cnn, device):
+    # One conv encoder feeds both the actor and the critic heads. Returns the
+    # encoder, its target and the size of the state features; without the
+    # CNN the features are the flattened state
+    if not (image_obs and cnn):
+        encoder = nn.Identity()
+        return encoder, encoder, state_dim ** 2 if image_obs else state_dim
+
+    encoder = Encoder(state_dim).to(device)
+    encoder_target = Encoder(state_dim).to(device)
+    encoder_target.load_state_dict(encoder.state_dict())
+    encoder_target.requires_grad_(False)
+    # Only the conv encoders are compiled, the small MLP heads do not recoup
+    # the compile overhead. Module.compile works in place, so state_dict keys
+    # and saved checkpoints are unchanged
+    for net in (encoder, encoder_target):
+        net.compile(mode="default", dynamic=False)
+    return encoder, encoder_target, encoder.out_dim
+
+
+def target_param_lists(*pairs):
+    # Parameter lists of (net, target) pairs for the fused (foreach lerp) soft
+    # target updates
+    params, target_params = [], []
+    for net, target in pairs:
+        params += [p.data for p in net.parameters()]
+        target_params += [p.data for p in target.parameters()]
+    return params, target_params
+
+
+def amp_enabled(amp, device):
+    # bf16 autocast only pays off on GPUs with bf16 tensor cores
+    return amp and device.type == "cuda" and torch.cuda.is_bf16_supported()
+
+
+def bf16_autocast(device, enabled):
+    # Forward passes and losses run in bf16; parameters, backward and the
+    # optimizer steps stay in fp32, so no gradient scaling is needed
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=enabled)
+
+
+# Checkpoints from before the Q heads were stacked and the conv stack moved
+# into a shared Encoder. The critic had separate fcn_1/fcn_2 input layers and
+# l1/l2 (Q1) and l3/l4 (Q2) output layers, and both the actor and the critic
+# kept their own conv stack as cnn.*
+def pop_legacy_cnn(state_dict, prefix=""):
+    # Removes the cnn.* keys and returns them as an Encoder state_dict
+    keys = [k for k in state_dict if k.startswith(prefix + "cnn.")]
+    return {k[len(prefix):]: state_dict.pop(k) for k in keys}
+
+
+def remap_legacy_critic(state_dict, prefix, action_dim):
+    # Rewrites the old critic keys in place into the stacked layout
+    pop_legacy_cnn(state_dict, prefix)
+    w1 = state_dict.pop(prefix + "fcn_1.0.weight")
+    w2 = state_dict.pop(prefix + "fcn_2.0.weight")
+    feature_dim = w1.shape[1] - action_dim
+    state_dict[prefix + "fcn_state.weight"] = torch.cat(
+        [w1[:, :feature_dim], w2[:, :feature_dim]])
+    state_dict[prefix + "fcn_action.weight"] = torch.cat(
+        [w1[:, feature_dim:], w2[:, feature_dim:]])
+    state_dict[prefix + "fcn_action.bias"] = torch.cat(
+        [state_dict.pop(prefix + "fcn_1.0.bias"), state_dict.pop(prefix + "fcn_2.0.bias")])
+
+    # StackedLinear keeps (n, in, out) weights and (n, 1, out) biases
+    pairs = [("fcn_out", "fcn_1.2", "fcn_2.2"), ("l1", "l1", "l3"), ("l2", "l2", "l4")]
+    for new, q1, q2 in pairs:
+        if prefix + q1 + ".weight" not in state_dict:
+            continue
+        weight = [state_dict.pop(prefix + q + ".weight").t() for q in (q1, q2)]
+        bias = [state_dict.pop(prefix + q + ".bias") for q in (q1, q2)]
+        state_dict[prefix + new + ".weight"] = torch.stack(weight)
+        state_dict[prefix + new + ".bias"] = torch.stack(bias).unsqueeze(1)
+
+
+# Checkpoint files of an agent with actor, critic and encoder networks and
+# their targets. The _encoder file only exists when the CNN is used
+def save_checkpoint(agent, filename):
+    torch.save(agent.critic.state_dict(), filename + "_critic")
+    torch.save(agent.critic_optimizer.state_dict(), filename + "_critic_optimizer")
+
+    torch.save(agent.actor.state_dict(), filename + "_actor")
+    torch.save(agent.actor_optimizer.state_dict(), filename + "_actor_optimizer")
+
+    if agent.use_cnn:
+        torch.save(agent.encoder.state_dict(), filename + "_encoder")
+
+
+def load_checkpoint(agent, filename):
+    critic_state = torch.load(filename + "_critic")
+    actor_state = torch.load(filename + "_actor")
+    # Checkpoints from before the shared encoder have no _encoder file and
+    # keep a conv stack in both the actor and the critic. The critic's copy
+    # becomes the encoder, so the actor of such a checkpoint sees different
+    # features than it was trained on. Their optimizer states do not match
+    # the new parameter layout and are not loaded
+    legacy = "fcn_1.0.weight" in critic_state
+    encoder_state = pop_legacy_cnn(critic_state)
+    pop_legacy_cnn(actor_state)
+    if agent.use_cnn:
+        if not encoder_state:
+            encoder_state = torch.load(filename + "_encoder")
+        agent.encoder.load_state_dict(encoder_state)
+        agent.encoder_target.load_state_dict(agent.encoder.state_dict())
+
+    agent.critic.load_state_dict(critic_state)
+    agent.critic_target.load_state_dict(agent.critic.state_dict())
+
+    agent.actor.load_state_dict(actor_state)
+    agent.actor_target.load_state_dict(agent.actor.state_dict())
+
+    if not legacy:
+        agent.critic_optimizer.load_state_dict(torch.load(filename + "_critic_optimizer"))
+        agent.actor_optimizer.load_state_dict(torch.load(filename + "_actor_optimizer"))
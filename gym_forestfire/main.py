@@ -113,6 +113,9 @@ if __name__ == "__main__":
         policy.load(f"./models/{policy_file}")
 
     replay_buffer = utils.ReplayBuffer(state_dim, action_dim, image_obs=image_obs)
+    # Prefetching only pays off when batches are copied to the GPU
+    if replay_buffer.device.type == "cuda":
+        replay_buffer = utils.PrefetchReplayBuffer(replay_buffer, args.batch_size)
 
     # Evaluate untrained policy
     evaluations = [eval_policy(policy, args.env, args.seed)]
@@ -168,6 +171,9 @@ if __name__ == "__main__":
             np.save(f"./results/{file_name}", evaluations)
             if args.save_model: policy.save(f"./models/{file_name}")
 
+    # Stop the first run's prefetch thread before the second run builds its own
+    if isinstance(replay_buffer, utils.PrefetchReplayBuffer):
+        replay_buffer.close()
 
 #TD3 is the algorithm used
 
@@ -219,6 +225,9 @@ if __name__ == "__main__":
         policy.load(f"./models/{policy_file}")
 
     replay_buffer = utils.ReplayBuffer(state_dim, action_dim, image_obs=image_obs)
+    # Prefetching only pays off when batches are copied to the GPU
+    if replay_buffer.device.type == "cuda":
+        replay_buffer = utils.PrefetchReplayBuffer(replay_buffer, args.batch_size)
 
     # Evaluate untrained policy
     evaluations = [eval_policy(policy, args.env, args.seed)]